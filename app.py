@@ -1,77 +1,390 @@
 import eventlet
 eventlet.monkey_patch()
+import eventlet.semaphore
 from flask import Flask, render_template, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from pymongo import MongoClient
-from datetime import datetime, timedelta
-import pytz
-import random
+from pymongo import MongoClient, ReturnDocument, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, timedelta, timezone
+import cachetools
+import orjson
 import string
 import os
 import threading
+import atexit
+import collections
+import contextlib
+import logging
+import logging.handlers
+import queue
+import socket
 import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Set timezone to Asia/Kolkata
-TIMEZONE = pytz.timezone('Asia/Kolkata')
+# Log through a queue drained by a listener thread so event handlers never
+# block on stdout
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING').upper()
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+
+logger = logging.getLogger('scribe')
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.setLevel(LOG_LEVEL)
+
 GRACE_PERIOD_SECONDS = 600  # 10 minutes
+ROOM_TTL_SECONDS = 24 * 60 * 60  # Idle rooms expire after 24 hours
+ROOM_CODE_INSERT_ATTEMPTS = 5
+MAX_ROOM_MEMBERS = 5
+HISTORY_LIMIT = 50  # Messages sent to a joining user
+STORED_MESSAGE_LIMIT = 200  # Messages kept per room
+ROOM_CODE_LENGTH = 6
+ROOM_CODE_ALPHABET = (string.ascii_uppercase + string.digits).encode()
+MESSAGE_FLUSH_SECONDS = 0.5
+MESSAGE_FLUSH_BATCH_SIZE = 20
+MAX_MESSAGE_LENGTH = 2000  # Characters; keeps STORED_MESSAGE_LIMIT messages well under 16MB
+USER_LIST_DEBOUNCE_SECONDS = 0.1
+CODE_POOL_LOW_WATER = 32
+CODE_POOL_BATCH_SIZE = 64
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class OrjsonModule:
+    """orjson stand-in for the json module Socket.IO encodes packets with"""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key')
+app.json = ORJSONProvider(app)
+
+# Optional Redis message queue so room broadcasts fan out across workers
+REDIS_URL = os.getenv('REDIS_URL')
 
-# Initialize SocketIO with CORS support
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Initialize SocketIO with CORS support on the eventlet hub so that the
+# monkey-patched MongoDB socket I/O yields cooperatively
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', message_queue=REDIS_URL, json=OrjsonModule)
 
 # MongoDB setup
 MONGODB_URI = os.getenv('MONGODB_URI')
 DATABASE_NAME = 'scribe_chat'
 
-client = MongoClient(MONGODB_URI)
+# Pool sized for the eventlet worker's greenlets; minPoolSize keeps warm
+# connections so short operations skip the TCP/TLS handshake
+client = MongoClient(
+    MONGODB_URI,
+    maxPoolSize=200,
+    minPoolSize=20,
+    waitQueueTimeoutMS=2000,
+    serverSelectionTimeoutMS=3000,
+    retryWrites=True,
+    w=1,
+    readPreference='primaryPreferred',
+    compressors='zstd,zlib',
+    tz_aware=True  # Every datetime in the database is UTC; read it back as such
+)
 db = client[DATABASE_NAME]
 rooms_collection = db['rooms']
 
 # Create unique index on room_code
 rooms_collection.create_index('room_code', unique=True)
 
+# Index disconnected members so the grace-period sweep doesn't scan the
+# whole collection
+rooms_collection.create_index([('members.status', 1), ('members.last_seen', 1)])
+
+# Let MongoDB's TTL monitor delete rooms that have been idle too long
+rooms_collection.create_index('last_active_at', expireAfterSeconds=ROOM_TTL_SECONDS)
+
+# Write-through cache of room documents (without message history), keyed by
+# room_code. Every handler that mutates a room refreshes or drops its entry.
+ROOM_CACHE = cachetools.TTLCache(maxsize=10_000, ttl=60)
+ROOM_PROJECTION = {
+    '_id': 0,
+    'room_code': 1,
+    'room_name': 1,
+    'host_sid': 1,
+    'is_code_visible': 1,
+    'members': 1
+}
+
+# Aggregation expression for a room's members; new rooms have no members
+# field until someone joins
+MEMBERS_OR_EMPTY = {'$ifNull': ['$members', []]}
+
+# Joins need the room plus only the tail of its message history
+JOIN_PROJECTION = {'_id': 0, 'messages': {'$slice': -HISTORY_LIMIT}}
+room_cache_lock = threading.Lock()
+
+# Process-local map of sid -> (room_code, username) for sockets that joined
+# a room, so disconnects don't have to search rooms by member sid
+SID_INDEX = {}
+
+# Pre-generated room codes not yet in use, refilled by fill_code_pool
+CODE_POOL = collections.deque(maxlen=256)
+
+# Per-room locks serializing membership and host changes within this process
+ROOM_LOCKS = collections.defaultdict(lambda: eventlet.semaphore.Semaphore(1))
+
+# Scheduled update_user_list emits, room_code -> pending GreenThread
+PENDING_USER_LISTS = {}
+
+# Messages not yet written to MongoDB, room_code -> [message, ...]
+PENDING_MESSAGES = collections.defaultdict(list)
+
+# Batch taken from PENDING_MESSAGES by the flush currently writing it, kept
+# readable so joins during the write still see those messages
+FLUSHING_MESSAGES = {}
+
+# Held for a whole flush so batches for a room are written one at a time
+pending_lock = eventlet.semaphore.Semaphore(1)
+
+def generate_room_codes(count):
+    """Generate random 6-character alphanumeric room codes from one urandom read.
+
+    Uniqueness is enforced by the unique index on room_code at insert time.
+    """
+    raw = bytes(ROOM_CODE_ALPHABET[b % len(ROOM_CODE_ALPHABET)] for b in os.urandom(ROOM_CODE_LENGTH * count))
+    return [raw[i:i + ROOM_CODE_LENGTH].decode() for i in range(0, len(raw), ROOM_CODE_LENGTH)]
+
 def generate_room_code():
-    """Generate a unique 6-character alphanumeric room code"""
+    """Generate a single random room code"""
+    return generate_room_codes(1)[0]
+
+def next_room_code():
+    """Take a room code from CODE_POOL, generating one if the pool is empty"""
+    try:
+        return CODE_POOL.popleft()
+    except IndexError:
+        return generate_room_code()
+
+def fill_code_pool():
+    """Background task to keep CODE_POOL stocked with unused room codes"""
     while True:
-        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-        if not rooms_collection.find_one({'room_code': code}):
-            return code
+        try:
+            if len(CODE_POOL) < CODE_POOL_LOW_WATER:
+                # Dedupe in memory against the batch and the pool before
+                # asking MongoDB which candidates are already taken
+                pooled = set(CODE_POOL)
+                candidates = list({code for code in generate_room_codes(CODE_POOL_BATCH_SIZE) if code not in pooled})
+                taken = {
+                    room['room_code'] for room in rooms_collection.find(
+                        {'room_code': {'$in': candidates}},
+                        {'_id': 0, 'room_code': 1}
+                    )
+                }
+                CODE_POOL.extend(code for code in candidates if code not in taken)
+        except Exception:
+            logger.exception('Error filling room code pool')
+        
+        socketio.sleep(0.5)
 
-def update_room_activity(room_code):
-    """Update the last_active_at timestamp for a room"""
-    rooms_collection.update_one(
+def cache_room(room):
+    """Store a room (without its message history) in ROOM_CACHE"""
+    entry = {k: v for k, v in room.items() if k != 'messages'}
+    with room_cache_lock:
+        ROOM_CACHE[room['room_code']] = entry
+    return entry
+
+def invalidate_room(room_code):
+    """Drop a room from ROOM_CACHE after it has been modified"""
+    with room_cache_lock:
+        ROOM_CACHE.pop(room_code, None)
+
+def get_room(room_code):
+    """Fetch a room (without message history), served from ROOM_CACHE when possible"""
+    with room_cache_lock:
+        room = ROOM_CACHE.get(room_code)
+    if room is None:
+        room = rooms_collection.find_one({'room_code': room_code}, ROOM_PROJECTION)
+        if room:
+            room = cache_room(room)
+    return room
+
+def get_member_count(room_code):
+    """Return the number of members in a room, or None if it doesn't exist.
+
+    Served from ROOM_CACHE when possible, otherwise MongoDB computes the
+    count so the members array never crosses the wire.
+    """
+    with room_cache_lock:
+        room = ROOM_CACHE.get(room_code)
+    if room is not None:
+        return len(room.get('members', []))
+    
+    room = rooms_collection.find_one(
         {'room_code': room_code},
-        {'$set': {'last_active_at': datetime.now(TIMEZONE)}}
+        {'_id': 0, 'member_count': {'$size': MEMBERS_OR_EMPTY}}
     )
+    return room['member_count'] if room else None
+
+def build_user_list(room):
+    """Build the update_user_list payload for a room.
+
+    It is emitted once to the Socket.IO room, which encodes the packet a
+    single time for all recipients.
+    """
+    return [{
+        'username': m['username'],
+        'is_host': m['sid'] == room['host_sid'],
+        'is_active': m.get('status', 'active') == 'active'
+    } for m in room.get('members', [])]
+
+def schedule_user_list(room_code):
+    """Emit the room's user list shortly, coalescing bursts of joins and leaves"""
+    pending = PENDING_USER_LISTS.pop(room_code, None)
+    if pending:
+        pending.cancel()
+    PENDING_USER_LISTS[room_code] = eventlet.spawn_after(
+        USER_LIST_DEBOUNCE_SECONDS, flush_user_list, room_code
+    )
+
+def flush_user_list(room_code):
+    """Send the current user list to a room"""
+    PENDING_USER_LISTS.pop(room_code, None)
+    try:
+        room = get_room(room_code)
+        if room:
+            socketio.emit('update_user_list', build_user_list(room), to=room_code)
+    except Exception:
+        logger.exception('Error sending user list for %s', room_code)
+
+def flush_messages():
+    """Write all buffered messages to MongoDB in one bulk write.
+
+    Each room keeps only its most recent messages so the document stays
+    bounded, and the write doubles as the room's activity update. Batches
+    that hit a transient failure go back to the front of PENDING_MESSAGES
+    for the next flush; writes the server rejected would only fail again,
+    so those are dropped.
+    """
+    with pending_lock:
+        if not PENDING_MESSAGES:
+            return
+        
+        batch = dict(PENDING_MESSAGES)
+        PENDING_MESSAGES.clear()
+        FLUSHING_MESSAGES.update(batch)
+        codes = list(batch)
+        now = datetime.now(timezone.utc)
+        
+        try:
+            rooms_collection.bulk_write([
+                UpdateOne({'room_code': code}, {
+                    '$push': {'messages': {'$each': batch[code], '$slice': -STORED_MESSAGE_LIMIT}},
+                    '$set': {'last_active_at': now}
+                })
+                for code in codes
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Unordered writes for the other rooms went through
+            for error in e.details['writeErrors']:
+                code = codes[error['index']]
+                logger.error('Dropped %d messages for %s: %s', len(batch[code]), code, error.get('errmsg'))
+        except Exception:
+            logger.exception('Error flushing messages')
+            requeue_messages(batch, codes)
+        finally:
+            FLUSHING_MESSAGES.clear()
+
+def requeue_messages(batch, codes):
+    """Put unwritten messages back ahead of any buffered since the flush began"""
+    for code in codes:
+        PENDING_MESSAGES[code] = (batch[code] + PENDING_MESSAGES.get(code, []))[-STORED_MESSAGE_LIMIT:]
+
+def buffered_messages(room_code):
+    """Return a copy of a room's messages not yet confirmed written to MongoDB"""
+    return FLUSHING_MESSAGES.get(room_code, []) + PENDING_MESSAGES.get(room_code, [])
+
+def unsaved_messages(saved, *buffers):
+    """Merge buffered_messages copies, oldest first, without the ones in saved.
+
+    The buffers share message objects, so repeats are dropped by identity;
+    saved came from MongoDB and is compared by value.
+    """
+    seen = set()
+    unsaved = []
+    for buffer in buffers:
+        for message in buffer:
+            if id(message) not in seen and message not in saved:
+                seen.add(id(message))
+                unsaved.append(message)
+    return unsaved
+
+def flush_messages_periodically():
+    """Background task to flush buffered messages every MESSAGE_FLUSH_SECONDS"""
+    while True:
+        socketio.sleep(MESSAGE_FLUSH_SECONDS)
+        flush_messages()
+
+# Write out whatever is still buffered when the worker shuts down, so
+# restarts and redeploys don't lose messages
+atexit.register(flush_messages)
+
+# TEMPLATES_AUTO_RELOAD is left at its default, which follows app.debug, so
+# only the debug server checks templates for changes. Pages without
+# per-request data are rendered once at startup and re-rendered in debug.
+DEFAULT_ERROR_MESSAGE = 'An error occurred. The room may have been deleted or you may have been disconnected.'
+
+with app.test_request_context():
+    INDEX_HTML = render_template('index.html')
+    DEFAULT_ERROR_HTML = render_template('error.html', message=DEFAULT_ERROR_MESSAGE)
+    ROOM_NOT_FOUND_HTML = render_template('error.html', message='Room not found')
+    ROOM_FULL_HTML = render_template('error.html', message='Room is full')
+
+CHAT_TEMPLATE = app.jinja_env.get_template('chat.html')
+
+def prerendered(html, template_name, **context):
+    """Return a page rendered at startup, or render it afresh in debug"""
+    if app.debug:
+        return render_template(template_name, **context)
+    return html
 
 # HTTP Routes
 @app.route('/')
 def index():
     """Serve the homepage"""
-    return render_template('index.html')
+    return prerendered(INDEX_HTML, 'index.html')
 
 @app.route('/error')
 def error_page():
     """Serve the error page with custom message"""
-    message = request.args.get('message', 'An error occurred. The room may have been deleted or you may have been disconnected.')
+    message = request.args.get('message')
+    if not message:
+        return prerendered(DEFAULT_ERROR_HTML, 'error.html', message=DEFAULT_ERROR_MESSAGE)
     return render_template('error.html', message=message)
 
 @app.route('/chat/<room_code>')
 def chat_room(room_code):
     """Serve the chat room page"""
-    room = rooms_collection.find_one({'room_code': room_code.upper()})
-    if not room:
-        return render_template('error.html', message='Room not found'), 404
+    member_count = get_member_count(room_code.upper())
+    if member_count is None:
+        return prerendered(ROOM_NOT_FOUND_HTML, 'error.html', message='Room not found'), 404
     
-    if len(room.get('members', [])) >= 5:
-        return render_template('error.html', message='Room is full'), 403
+    if member_count >= MAX_ROOM_MEMBERS:
+        return prerendered(ROOM_FULL_HTML, 'error.html', message='Room is full'), 403
     
-    return render_template('chat.html', room_code=room_code.upper())
+    if app.debug:
+        return render_template('chat.html', room_code=room_code.upper())
+    return CHAT_TEMPLATE.render(room_code=room_code.upper())
 
 @app.route('/api/create_room', methods=['POST'])
 def create_room():
@@ -83,20 +396,27 @@ def create_room():
         if not username:
             return jsonify({'success': False, 'error': 'Username is required'}), 400
         
-        room_code = generate_room_code()
-        
         room_doc = {
-            'room_code': room_code,
             'room_name': f"{username}'s Room",
             'host_sid': None,  # Will be set when host connects via socket
-            'members': [],
-            'messages': [],  # Store chat history
+            # members and messages are created by the first $push to them
             'is_code_visible': False,
-            'created_at': datetime.now(TIMEZONE),
-            'last_active_at': datetime.now(TIMEZONE)
+            'created_at': datetime.now(timezone.utc),
+            'last_active_at': datetime.now(timezone.utc)
         }
         
-        rooms_collection.insert_one(room_doc)
+        # Let the unique index reject the rare colliding code instead of
+        # probing for it before every insert
+        for _ in range(ROOM_CODE_INSERT_ATTEMPTS):
+            room_code = next_room_code()
+            room_doc['room_code'] = room_code
+            try:
+                rooms_collection.insert_one(room_doc)
+                break
+            except DuplicateKeyError:
+                continue
+        else:
+            return jsonify({'success': False, 'error': 'Could not allocate a room code, please try again'}), 503
         
         return jsonify({'success': True, 'room_code': room_code})
     
@@ -114,12 +434,12 @@ def validate_room():
         if not room_code:
             return jsonify({'valid': False, 'reason': 'Room code is required'})
         
-        room = rooms_collection.find_one({'room_code': room_code})
+        member_count = get_member_count(room_code)
         
-        if not room:
+        if member_count is None:
             return jsonify({'valid': False, 'reason': 'Room not found'})
         
-        if len(room.get('members', [])) >= 5:
+        if member_count >= MAX_ROOM_MEMBERS:
             return jsonify({'valid': False, 'reason': 'Room is full'})
         
         # Check if username is provided
@@ -136,58 +456,52 @@ def validate_room():
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
-    print(f'Client connected: {request.sid}')
+    logger.debug('Client connected: %s', request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection with grace period"""
-    print(f'Client disconnected: {request.sid}')
+    logger.debug('Client disconnected: %s', request.sid)
     
-    # Find room where this user is a member
-    room = rooms_collection.find_one({'members.sid': request.sid})
+    # Look up the room this socket joined instead of scanning every room
+    entry = SID_INDEX.pop(request.sid, None)
+    if not entry:
+        return
+    room_code, username = entry
     
-    if room:
-        room_code = room['room_code']
-        
-        # Update member status to disconnected
-        rooms_collection.update_one(
+    with ROOM_LOCKS[room_code]:
+        # Update member status to disconnected and get the updated room back
+        room = rooms_collection.find_one_and_update(
             {'room_code': room_code, 'members.sid': request.sid},
             {'$set': {
                 'members.$.status': 'disconnected',
-                'members.$.last_seen': datetime.now(TIMEZONE)
-            }}
+                'members.$.last_seen': datetime.now(timezone.utc)
+            }},
+            projection=ROOM_PROJECTION,
+            return_document=ReturnDocument.AFTER
         )
         
-        # Get updated room to check host status
-        room = rooms_collection.find_one({'room_code': room_code})
-        member = next((m for m in room['members'] if m['sid'] == request.sid), None)
+        if not room:
+            # Room was deleted or this sid was replaced by a reconnect
+            invalidate_room(room_code)
+            return
         
-        if member:
-            username = member['username']
-            
-            # If host disconnected, notify others about potential transfer
-            if room['host_sid'] == request.sid:
-                emit('system_message', {
-                    'text': f'Host {username} has disconnected. Room will close or transfer host in 10 minutes.'
-                }, room=room_code)
-                
-                emit('host_disconnect_grace', {
-                    'username': username,
-                    'is_host_disconnect': True,
-                    'seconds_left': GRACE_PERIOD_SECONDS
-                }, room=room_code)
-
-            # Update user list to show disconnected status
-            user_list = []
-            for m in room['members']:
-                is_active = m.get('status', 'active') == 'active'
-                user_list.append({
-                    'username': m['username'],
-                    'is_host': m['sid'] == room['host_sid'],
-                    'is_active': is_active
-                })
+        cache_room(room)
+        
+        # If host disconnected, notify others about potential transfer
+        if room['host_sid'] == request.sid:
+            emit('system_message', {
+                'text': f'Host {username} has disconnected. Room will close or transfer host in 10 minutes.'
+            }, room=room_code)
             
-            emit('update_user_list', user_list, room=room_code)
+            emit('host_disconnect_grace', {
+                'username': username,
+                'is_host_disconnect': True,
+                'seconds_left': GRACE_PERIOD_SECONDS
+            }, room=room_code)
+
+        # Update user list to show disconnected status
+        schedule_user_list(room_code)
 
 @socketio.on('join_room')
 def handle_join_room(data):
@@ -196,133 +510,134 @@ def handle_join_room(data):
         room_code = data['room_code'].upper()
         username = data['username'].strip()
         
-        room = rooms_collection.find_one({'room_code': room_code})
-        
-        if not room:
-            emit('error', {'message': 'Room not found'})
-            return
-        
-        if len(room['members']) >= 5:
-            emit('error', {'message': 'Room is full'})
-            return
-        
-        # Check if username already exists in room
-        existing_member = next((m for m in room['members'] if m['username'] == username), None)
-        
-        member_data = {
-            'username': username,
-            'sid': request.sid,
-            'status': 'active',
-            'last_seen': datetime.now(TIMEZONE)
-        }
-        
-        is_reconnect = False
-        
-        if existing_member:
-            # User is rejoining
-            rooms_collection.update_one(
-                {'room_code': room_code, 'members.username': username},
-                {'$set': {
-                    'members.$.sid': request.sid,
-                    'members.$.status': 'active',
-                    'members.$.last_seen': datetime.now(TIMEZONE)
-                }}
-            )
-            is_reconnect = True
+        with ROOM_LOCKS[room_code]:
+            now = datetime.now(timezone.utc)
+            member_data = {
+                'username': username,
+                'sid': request.sid,
+                'status': 'active',
+                'last_seen': now
+            }
             
-            # If they were host, update host_sid
-            if room['host_sid'] == existing_member['sid']: # Check against old SID
-                rooms_collection.update_one(
-                    {'room_code': room_code},
-                    {'$set': {'host_sid': request.sid}}
-                )
-                emit('host_returned', {}, room=room_code)
-        else:
-            # New member
-            # If this is the first member (or all others are disconnected/gone), make them host
-            # actually logic: if no host_sid or host is invalid, or just simple first join
-            is_first = not room['members']
+            is_reconnect = False
             
-            if is_first:
-                rooms_collection.update_one(
-                    {'room_code': room_code},
-                    {
-                        '$set': {'host_sid': request.sid},
-                        '$push': {'members': member_data}
-                    }
-                )
-            else:
-                rooms_collection.update_one(
-                    {'room_code': room_code},
-                    {'$push': {'members': member_data}}
+            # Copy the unwritten messages before reading the room: a flush
+            # can write them after the read and clear its buffer before this
+            # handler resumes
+            buffered = buffered_messages(room_code)
+            
+            # New member: capacity, username uniqueness and first-member host
+            # assignment are checked and applied atomically in one round-trip
+            updated_room = rooms_collection.find_one_and_update(
+                {
+                    'room_code': room_code,
+                    'members.username': {'$ne': username},
+                    '$expr': {'$lt': [{'$size': MEMBERS_OR_EMPTY}, MAX_ROOM_MEMBERS]}
+                },
+                [{'$set': {
+                    'host_sid': {'$cond': [{'$eq': [{'$size': MEMBERS_OR_EMPTY}, 0]}, request.sid, '$host_sid']},
+                    'members': {'$concatArrays': [MEMBERS_OR_EMPTY, [{'$literal': member_data}]]},
+                    'last_active_at': now
+                }}],
+                projection=JOIN_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+            
+            if not updated_room:
+                # User is rejoining: swap in the new sid, keeping the old one
+                # from the pre-update document for the host check below
+                room = rooms_collection.find_one_and_update(
+                    {'room_code': room_code, 'members.username': username},
+                    {'$set': {
+                        'members.$.sid': request.sid,
+                        'members.$.status': 'active',
+                        'members.$.last_seen': now,
+                        'last_active_at': now
+                    }},
+                    projection=JOIN_PROJECTION,
+                    return_document=ReturnDocument.BEFORE
                 )
-        
-        # Join Socket.IO room
-        join_room(room_code)
-        
-        # Update activity
-        update_room_activity(room_code)
-        
-        # Get updated room data
-        updated_room = rooms_collection.find_one({'room_code': room_code})
-        
-        # Send room info to the joining user
-        emit('room_info', {
-            'room_name': updated_room['room_name'],
-            'room_code': room_code,
-            'is_code_visible': updated_room['is_code_visible'],
-            'is_host': request.sid == updated_room['host_sid'],
-            'username': username
-        })
-        
-        # Check if host is currently disconnected
-        host_sid = updated_room.get('host_sid')
-        host_member = next((m for m in updated_room['members'] if m['sid'] == host_sid), None)
-        
-        if host_member and host_member.get('status') == 'disconnected':
-            last_seen = host_member.get('last_seen', datetime.min.replace(tzinfo=TIMEZONE))
-            # Ensure last_seen is timezone aware
-            if last_seen.tzinfo is None:
-                last_seen = pytz.utc.localize(last_seen).astimezone(TIMEZONE)
                 
-            elapsed = (datetime.now(TIMEZONE) - last_seen).total_seconds()
-            remaining = max(0, GRACE_PERIOD_SECONDS - elapsed)
+                if not room:
+                    # Only the error path pays for a second read
+                    if rooms_collection.find_one({'room_code': room_code}, {'_id': 1}):
+                        emit('error', {'message': 'Room is full'})
+                    else:
+                        emit('error', {'message': 'Room not found'})
+                        ROOM_LOCKS.pop(room_code, None)
+                    return
+                
+                is_reconnect = True
+                existing_member = next(m for m in room['members'] if m['username'] == username)
+                
+                # If they were host, update host_sid
+                if room['host_sid'] == existing_member['sid']: # Check against old SID
+                    rooms_collection.update_one(
+                        {'room_code': room_code, 'host_sid': existing_member['sid']},
+                        {'$set': {'host_sid': request.sid}}
+                    )
+                    room['host_sid'] = request.sid
+                    emit('host_returned', {}, room=room_code)
+                
+                # Retire the superseded socket so it can no longer post as
+                # this member
+                SID_INDEX.pop(existing_member['sid'], None)
+                existing_member.update(sid=request.sid, status='active', last_seen=now)
+                updated_room = room
             
-            if remaining > 0:
-                emit('host_disconnect_grace', {
-                    'username': host_member['username'],
-                    'is_host_disconnect': True,
-                    'seconds_left': remaining
-                }, room=request.sid) # Send only to the joining user
-        
-        # Send chat history (last 50 messages)
-        history = updated_room.get('messages', [])[-50:]
-        emit('chat_history', history)
-
-        # Notify others
-        if is_reconnect:
-             emit('system_message', {
-                'text': f'{username} has reconnected.'
-            }, room=room_code, skip_sid=request.sid)
-        else:
-            emit('system_message', {
-                'text': f'{username} has joined the chat.'
-            }, room=room_code, skip_sid=request.sid)
-        
-        # Send updated user list to all
-        user_list = []
-        for m in updated_room['members']:
-            is_active = m.get('status', 'active') == 'active'
-            user_list.append({
-                'username': m['username'],
-                'is_host': m['sid'] == updated_room['host_sid'],
-                'is_active': is_active
+            cache_room(updated_room)
+            SID_INDEX[request.sid] = (room_code, username)
+            
+            # Join Socket.IO room
+            join_room(room_code)
+            
+            # Send room info to the joining user
+            emit('room_info', {
+                'room_name': updated_room['room_name'],
+                'room_code': room_code,
+                'is_code_visible': updated_room['is_code_visible'],
+                'is_host': request.sid == updated_room['host_sid'],
+                'username': username
             })
+            
+            # Check if host is currently disconnected
+            host_sid = updated_room.get('host_sid')
+            host_member = next((m for m in updated_room['members'] if m['sid'] == host_sid), None)
+            
+            if host_member and host_member.get('status') == 'disconnected':
+                last_seen = host_member.get('last_seen', datetime.min.replace(tzinfo=timezone.utc))
+                
+                elapsed = (now - last_seen).total_seconds()
+                remaining = max(0, GRACE_PERIOD_SECONDS - elapsed)
+                
+                if remaining > 0:
+                    emit('host_disconnect_grace', {
+                        'username': host_member['username'],
+                        'is_host_disconnect': True,
+                        'seconds_left': remaining
+                    }, room=request.sid) # Send only to the joining user
+            
+            # Send chat history, including messages still waiting to be written
+            saved = updated_room.get('messages', [])
+            unsaved = unsaved_messages(saved, buffered, buffered_messages(room_code))
+            history = (saved + unsaved)[-HISTORY_LIMIT:]
+            emit('chat_history', history)
+
+            # Notify others
+            if is_reconnect:
+                emit('system_message', {
+                    'text': f'{username} has reconnected.'
+                }, room=room_code, skip_sid=request.sid)
+            else:
+                emit('system_message', {
+                    'text': f'{username} has joined the chat.'
+                }, room=room_code, skip_sid=request.sid)
+            
+            # Send updated user list to all
+            schedule_user_list(room_code)
         
-        emit('update_user_list', user_list, room=room_code)
-        
-    except Exception as e:
-        print(f'Error in join_room: {e}')
+    except Exception:
+        logger.exception('Error in join_room')
         emit('error', {'message': 'Failed to join room'})
 
 @socketio.on('send_message')
@@ -335,48 +650,39 @@ def handle_send_message(data):
         if not message:
             return
         
-        room = rooms_collection.find_one({'room_code': room_code})
-        
-        if not room:
-            emit('error', {'message': 'Room not found'})
+        if len(message) > MAX_MESSAGE_LENGTH:
+            emit('error', {'message': f'Messages are limited to {MAX_MESSAGE_LENGTH} characters'})
             return
         
-        # Find sender
-        sender = next((m for m in room['members'] if m['sid'] == request.sid), None)
+        # Find sender from the session recorded at join time
+        entry = SID_INDEX.get(request.sid)
         
-        if not sender:
+        if not entry or entry[0] != room_code:
             emit('error', {'message': 'You are not in this room'})
             return
         
-        # Update activity
-        update_room_activity(room_code)
+        sender_username = entry[1]
         
-        # Broadcast message to room
+        # Timestamps are epoch milliseconds and formatted by the client
         message_data = {
-            'username': sender['username'],
+            'username': sender_username,
             'message': message,
-            'timestamp': datetime.now(TIMEZONE).isoformat(),
-            'is_own': False
+            'timestamp': int(time.time() * 1000)
         }
         
-        # Save to database
-        rooms_collection.update_one(
-            {'room_code': room_code},
-            {'$push': {'messages': {
-                'username': sender['username'],
-                'message': message,
-                'timestamp': message_data['timestamp']
-            }}}
-        )
-        
-        emit('receive_message', message_data, room=room_code, skip_sid=request.sid)
+        # Broadcast message to room, sender included; clients work out
+        # is_own themselves as they already do for chat history
+        emit('receive_message', message_data, room=room_code)
         
-        # Send back to sender with is_own flag
-        message_data['is_own'] = True
-        emit('receive_message', message_data)
+        # Buffer for the next batched write; flush early if a busy room
+        # has built up a full batch and no flush is already running
+        pending = PENDING_MESSAGES[room_code]
+        pending.append(message_data)
+        if len(pending) >= MESSAGE_FLUSH_BATCH_SIZE and not pending_lock.locked():
+            eventlet.spawn(flush_messages)
         
-    except Exception as e:
-        print(f'Error in send_message: {e}')
+    except Exception:
+        logger.exception('Error in send_message')
         emit('error', {'message': 'Failed to send message'})
 
 @socketio.on('host_action')
@@ -386,147 +692,227 @@ def handle_host_action(data):
         room_code = data['room_code'].upper()
         action = data['action']
         
-        room = rooms_collection.find_one({'room_code': room_code})
-        
-        if not room:
-            emit('error', {'message': 'Room not found'})
-            return
-        
-        # Verify user is host
-        if room['host_sid'] != request.sid:
-            emit('error', {'message': 'Only the host can perform this action'})
-            return
-        
+        # Reject malformed actions before ROOM_LOCKS, which is keyed by
+        # whatever room code the client sent, gets an entry for this one
         if action == 'rename_room':
             new_name = data.get('payload', '').strip()
-            if new_name:
-                rooms_collection.update_one(
-                    {'room_code': room_code},
-                    {'$set': {'room_name': new_name}}
+            if not new_name:
+                return
+        elif action not in ('toggle_code_visibility', 'delete_room'):
+            return
+        
+        with ROOM_LOCKS[room_code]:
+            # The host check lives in each write's filter, so verifying the
+            # host and applying the action take a single round-trip
+            host_filter = {'room_code': room_code, 'host_sid': request.sid}
+            
+            if action == 'rename_room':
+                room = rooms_collection.find_one_and_update(
+                    host_filter,
+                    {'$set': {'room_name': new_name}},
+                    projection=ROOM_PROJECTION,
+                    return_document=ReturnDocument.AFTER
                 )
                 
-                emit('room_updated', {
-                    'key': 'room_name',
-                    'value': new_name
-                }, room=room_code)
+                if room:
+                    cache_room(room)
+                    
+                    emit('room_updated', {
+                        'key': 'room_name',
+                        'value': new_name
+                    }, room=room_code)
+                    
+                    emit('system_message', {
+                        'text': f'Host changed the room name to "{new_name}"'
+                    }, room=room_code)
+            
+            elif action == 'toggle_code_visibility':
+                is_visible = data.get('payload', True)
+                room = rooms_collection.find_one_and_update(
+                    host_filter,
+                    {'$set': {'is_code_visible': is_visible}},
+                    projection=ROOM_PROJECTION,
+                    return_document=ReturnDocument.AFTER
+                )
                 
-                emit('system_message', {
-                    'text': f'Host changed the room name to "{new_name}"'
-                }, room=room_code)
-        
-        elif action == 'toggle_code_visibility':
-            is_visible = data.get('payload', True)
-            rooms_collection.update_one(
-                {'room_code': room_code},
-                {'$set': {'is_code_visible': is_visible}}
-            )
+                if room:
+                    cache_room(room)
+                    
+                    emit('room_updated', {
+                        'key': 'is_code_visible',
+                        'value': is_visible
+                    }, room=room_code)
             
-            emit('room_updated', {
-                'key': 'is_code_visible',
-                'value': is_visible
-            }, room=room_code)
-        
-        elif action == 'delete_room':
-            # Notify all users
-            emit('room_deleted', {
-                'message': 'The host has closed this room.'
-            }, room=room_code)
+            elif action == 'delete_room':
+                # Delete room from database
+                room = rooms_collection.find_one_and_delete(host_filter, projection={'_id': 1})
+                
+                if room:
+                    invalidate_room(room_code)
+                    ROOM_LOCKS.pop(room_code, None)
+                    
+                    # Notify all users
+                    emit('room_deleted', {
+                        'message': 'The host has closed this room.'
+                    }, room=room_code)
             
-            # Delete room from database
-            rooms_collection.delete_one({'room_code': room_code})
+            if not room:
+                # Only a rejected action pays for a fresh read to explain why
+                invalidate_room(room_code)
+                if get_room(room_code):
+                    emit('error', {'message': 'Only the host can perform this action'})
+                else:
+                    emit('error', {'message': 'Room not found'})
+                    ROOM_LOCKS.pop(room_code, None)
             
-    except Exception as e:
-        print(f'Error in host_action: {e}')
+    except Exception:
+        logger.exception('Error in host_action')
         emit('error', {'message': 'Failed to perform action'})
 
+def is_member_expired(member, cutoff):
+    """Check whether a disconnected member has been gone since before cutoff"""
+    if member.get('status') != 'disconnected':
+        return False
+    last_seen = member.get('last_seen', datetime.min.replace(tzinfo=timezone.utc))
+    return last_seen < cutoff
+
+def evict_room_locks():
+    """Drop idle ROOM_LOCKS entries for rooms that no longer exist,
+    such as rooms removed by the TTL monitor"""
+    idle_codes = [code for code, lock in list(ROOM_LOCKS.items()) if not lock.locked()]
+    if not idle_codes:
+        return
+    
+    existing = {
+        room['room_code'] for room in rooms_collection.find(
+            {'room_code': {'$in': idle_codes}},
+            {'_id': 0, 'room_code': 1}
+        )
+    }
+    for code in idle_codes:
+        lock = ROOM_LOCKS.get(code)
+        if code not in existing and lock and not lock.locked():
+            ROOM_LOCKS.pop(code, None)
+
 def check_grace_periods():
     """Background task to check for expired grace periods"""
     while True:
         try:
             # Check every 30 seconds
-            time.sleep(30)
+            socketio.sleep(30)
             
-            # Find rooms with disconnected members
-            rooms = rooms_collection.find({'members.status': 'disconnected'})
+            evict_room_locks()
             
-            for room in rooms:
-                room_code = room['room_code']
-                updated = False
-                host_changed = False
+            # Only fetch rooms that have a member past the grace period
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=GRACE_PERIOD_SECONDS)
+            expired_member = {'status': 'disconnected', 'last_seen': {'$lt': cutoff}}
+            expired_filter = {'members': {'$elemMatch': expired_member}}
+            room_codes = sorted(
+                room['room_code'] for room in rooms_collection.find(expired_filter, {'_id': 0, 'room_code': 1})
+            )
+            
+            if not room_codes:
+                continue
+            
+            operations = []
+            updated_rooms = []
+            deleted_codes = set()
+            
+            # Hold every affected room's lock, taken in a fixed order, so a
+            # rejoin can't change the members or host between the read and
+            # the write below
+            with contextlib.ExitStack() as held_locks:
+                for room_code in room_codes:
+                    held_locks.enter_context(ROOM_LOCKS[room_code])
                 
-                # Check each member
-                members_to_remove = []
-                for member in room['members']:
-                    if member.get('status') == 'disconnected':
-                        last_seen = member.get('last_seen', datetime.min.replace(tzinfo=TIMEZONE))
-                        # Ensure last_seen is timezone aware
-                        if last_seen.tzinfo is None:
-                            last_seen = pytz.utc.localize(last_seen).astimezone(TIMEZONE)
-                            
-                        if (datetime.now(TIMEZONE) - last_seen).total_seconds() > GRACE_PERIOD_SECONDS:
-                            members_to_remove.append(member['sid'])
-                            
-                if members_to_remove:
-                    # Remove expired members
-                    rooms_collection.update_one(
-                        {'room_code': room_code},
-                        {'$pull': {'members': {'sid': {'$in': members_to_remove}}}}
-                    )
-                    updated = True
-                    
-                    # Log removal
-                    expired_usernames = [m['username'] for m in room['members'] if m['sid'] in members_to_remove]
-                    print(f"Removed expired members from {room_code}: {expired_usernames}")
+                rooms = rooms_collection.find({'room_code': {'$in': room_codes}, **expired_filter}, ROOM_PROJECTION)
+                
+                for room in rooms:
+                    room_code = room['room_code']
+                    remaining = [m for m in room['members'] if not is_member_expired(m, cutoff)]
+                    expired_usernames = [m['username'] for m in room['members'] if is_member_expired(m, cutoff)]
                     
-                # Re-fetch room to check if empty or needs host update
-                if updated:
-                    updated_room = rooms_collection.find_one({'room_code': room_code})
+                    # Expired members are matched server-side, so anyone who
+                    # reconnected since the read above is left alone
+                    update = {'$pull': {'members': expired_member}}
+                    new_host = None
                     
-                    if not updated_room['members']:
-                        rooms_collection.delete_one({'room_code': room_code})
-                        print(f"Deleted empty room after grace period: {room_code}")
-                        continue
-                        
-                    # Check if host was removed
-                    if room['host_sid'] in members_to_remove:
+                    if not remaining:
+                        # Delete the room only if nobody active or still within
+                        # the grace period is left, whichever write runs first
+                        operations.append(DeleteOne({
+                            'room_code': room_code,
+                            'members': {'$not': {'$elemMatch': {'$or': [
+                                {'status': {'$ne': 'disconnected'}},
+                                {'last_seen': {'$gte': cutoff}}
+                            ]}}}
+                        }))
+                        deleted_codes.add(room_code)
+                    elif room['host_sid'] not in {m['sid'] for m in remaining}:
                         # Assign new host (first active member, or just first member)
-                        # Prefer active members
-                        new_host = next((m for m in updated_room['members'] if m.get('status') == 'active'), updated_room['members'][0])
-                        
-                        rooms_collection.update_one(
-                            {'room_code': room_code},
-                            {'$set': {'host_sid': new_host['sid']}}
-                        )
-                        
-                        emit('new_host', {'sid': new_host['sid']}, room=room_code)
-                        emit('system_message', {
-                            'text': f'Host rights transferred to {new_host["username"]} due to inactivity.'
-                        }, room=room_code)
-                        host_changed = True
-                        
-                    # Notify about removals
-                    for username in expired_usernames:
-                         emit('system_message', {
-                            'text': f'{username} was removed due to inactivity.'
-                        }, room=room_code)
-
-                    # Send updated list
-                    user_list = []
-                    for m in updated_room['members']:
-                        is_active = m.get('status', 'active') == 'active'
-                        user_list.append({
-                            'username': m['username'],
-                            'is_host': m['sid'] == updated_room['host_sid'], # Use new host sid if changed
-                            'is_active': is_active
-                        })
-                    emit('update_user_list', user_list, room=room_code)
+                        new_host = next((m for m in remaining if m.get('status') == 'active'), remaining[0])
+                        update['$set'] = {'host_sid': new_host['sid']}
                     
-        except Exception as e:
-            print(f"Error in grace period checker: {e}")
+                    operations.append(UpdateOne({'room_code': room_code}, update))
+                    updated_rooms.append((room, remaining, expired_usernames, new_host))
+                
+                if not operations:
+                    continue
+                
+                # Apply every room's removals in a single round-trip
+                result = rooms_collection.bulk_write(operations, ordered=False)
+                
+                if result.deleted_count < len(deleted_codes):
+                    # Someone came back to a room before its delete ran
+                    deleted_codes -= {
+                        room['room_code'] for room in rooms_collection.find(
+                            {'room_code': {'$in': list(deleted_codes)}},
+                            {'_id': 0, 'room_code': 1}
+                        )
+                    }
+            
+            for room, remaining, expired_usernames, new_host in updated_rooms:
+                room_code = room['room_code']
+                invalidate_room(room_code)
+                logger.info('Removed expired members from %s: %s', room_code, expired_usernames)
+                
+                if room_code in deleted_codes:
+                    ROOM_LOCKS.pop(room_code, None)
+                    logger.info('Deleted empty room after grace period: %s', room_code)
+                    continue
+                
+                if new_host:
+                    socketio.emit('new_host', {'sid': new_host['sid']}, to=room_code)
+                    socketio.emit('system_message', {
+                        'text': f'Host rights transferred to {new_host["username"]} due to inactivity.'
+                    }, to=room_code)
+                
+                # Notify about all removals in one message
+                socketio.emit('system_message', {
+                    'text': f"{', '.join(expired_usernames)} {'was' if len(expired_usernames) == 1 else 'were'} removed due to inactivity."
+                }, to=room_code)
+
+                # Send updated list
+                schedule_user_list(room_code)
+                
+        except Exception:
+            logger.exception('Error in grace period checker')
+
+# Start background tasks as greenlets on the eventlet hub
+socketio.start_background_task(check_grace_periods)
+socketio.start_background_task(flush_messages_periodically)
+socketio.start_background_task(fill_code_pool)
+
+eventlet_listen = eventlet.listen
 
-# Start background thread
-bg_thread = threading.Thread(target=check_grace_periods, daemon=True)
-bg_thread.start()
+def listen_nodelay(*args, **kwargs):
+    """eventlet.listen with Nagle disabled; accepted sockets inherit it"""
+    sock = eventlet_listen(*args, **kwargs)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
 
 if __name__ == '__main__':
+    # gunicorn already sets TCP_NODELAY on its listener; do the same for the
+    # development server so small emits aren't held back by Nagle
+    eventlet.listen = listen_nodelay
     socketio.run(app, host='0.0.0.0', port=8000, debug=True, allow_unsafe_werkzeug=True)
@@ -100,6 +100,7 @@ socket.on('chat_history', (messages) => {
 // Handle incoming messages
 socket.on('receive_message', (data) => {
     console.log('Message received:', data);
+    data.is_own = (data.username === username);
     addMessage(data, true);
 });
 